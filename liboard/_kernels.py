@@ -0,0 +1,70 @@
+#  LiBoard
+#  Copyright (C) 2021 Philipp Leclercq
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 3 as published by
+#  the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Per-square reductions over captured frames, compiled with Numba if it is installed."""
+
+import functools
+
+import numpy
+
+# Below this many frames NumPy's reductions are faster than importing and compiling the kernel
+JIT_MIN_FRAMES = 10_000
+
+
+def _frame_stats_loop(frames):
+    # Single pass over the frames; only worthwhile once compiled by Numba
+    n, w = frames.shape
+    if n == 0:
+        raise ValueError('Need at least one frame')
+    s = numpy.zeros(w, numpy.int64)
+    mn = frames[0].copy()
+    mx = frames[0].copy()
+    for i in range(n):
+        for j in range(w):
+            v = frames[i, j]
+            s[j] += v
+            if v < mn[j]:
+                mn[j] = v
+            if v > mx[j]:
+                mx[j] = v
+    return s // n, mn, mx
+
+
+@functools.lru_cache(maxsize=1)
+def _compiled_frame_stats():
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba.njit(cache=True)(_frame_stats_loop)
+
+
+def frame_stats(frames: numpy.ndarray):
+    """
+    Reduce captured frames per square.
+
+    Large multi-round captures (at least JIT_MIN_FRAMES rows) go through a single-pass kernel
+    compiled with Numba if it is installed; everything else uses NumPy's reductions.
+
+    :param frames: a (samples, 64) array, one row per snapshot
+    :return: the truncated mean (int64), minimum and maximum of each column
+    :raises ValueError: if there are no frames
+    """
+    if frames.shape[0] == 0:
+        raise ValueError('Need at least one frame')
+    if frames.shape[0] >= JIT_MIN_FRAMES and (kernel := _compiled_frame_stats()) is not None:
+        return kernel(frames)
+    return (frames.sum(axis=0, dtype=numpy.int64) // frames.shape[0],
+            frames.min(axis=0), frames.max(axis=0))
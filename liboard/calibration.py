@@ -0,0 +1,271 @@
+#  LiBoard
+#  Copyright (C) 2021 Philipp Leclercq
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 3 as published by
+#  the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""LiBoard submodule for reading sensor values and calibrating thresholds over USB."""
+
+import logging
+import re
+import time
+import weakref
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy
+import serial
+
+FILES = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
+RANKS = ['1', '2', '3', '4', '5', '6', '7', '8']
+SQUARES = [f'{f}{r}' for f in FILES for r in RANKS]  # A1..A8 order labels
+# Square label -> rank-major index: A1,B1,...,H1, A2,B2,...,H8
+SQ_TO_IDX = {f'{f}{r}': (int(r) - 1) * 8 + i for i, f in enumerate(FILES) for r in RANKS}
+# Row r holds the rank-major indices of rank r + 1 (A to H)
+RANK_INDICES = numpy.arange(64).reshape(8, 8)
+
+# 64 comma-separated ints: a '?' snapshot, or per-square thresholds from '!'
+_CSV_64 = rb'\s*(\d+)' + rb'\s*,\s*(\d+)' * 63 + rb'\s*'
+_SNAPSHOT_RE = re.compile(_CSV_64)
+# '!' may instead answer with a single global threshold; a trailing comma is tolerated
+_THRESHOLDS_RE = re.compile(rb'(?:' + _CSV_64 + rb'|\s*(\d+)\s*),?\s*')
+
+# Bytes received on each Serial object but not yet consumed as a complete line;
+# an entry goes away with its Serial, so a new connection never sees old bytes
+_rx_buffers: 'weakref.WeakKeyDictionary[serial.Serial, bytearray]' = weakref.WeakKeyDictionary()
+
+
+def _rx_buffer(ser: serial.Serial) -> bytearray:
+    return _rx_buffers.setdefault(ser, bytearray())
+
+
+def _readline(ser: serial.Serial, deadline: float) -> Optional[bytes]:
+    """
+    Read one line (without the newline) from the board.
+
+    Everything the port has buffered is drained in a single read instead of going byte by byte.
+    Returns None if a read times out, or if deadline (time.monotonic()) passes before a
+    newline arrives, so a port sending bytes without newlines cannot block forever.
+    """
+    buf = _rx_buffer(ser)
+    while True:
+        idx = buf.find(b'\n')
+        if idx >= 0:
+            line = bytes(buf[:idx])
+            del buf[:idx + 1]
+            return line
+        chunk = ser.read(max(1, ser.in_waiting))
+        if not chunk:
+            return None
+        buf += chunk
+        if b'\n' not in chunk and time.monotonic() >= deadline:
+            return None
+
+
+def _readlines(ser: serial.Serial, timeout_s: float) -> Iterator[bytes]:
+    """
+    Yield lines from the board until one read times out or timeout_s has passed overall.
+
+    The overall deadline is only checked once a line has been skipped or a read ended
+    without a newline, so a prompt reply still costs a single blocking read.
+    """
+    if ser.timeout != timeout_s:
+        ser.timeout = timeout_s  # reconfigures the port, so only when it changes
+    deadline = time.monotonic() + timeout_s
+    while (line := _readline(ser, deadline)) is not None:
+        yield line
+        if time.monotonic() >= deadline:
+            return
+
+
+def reset_input(ser: serial.Serial):
+    """Discard both the OS input buffer and the bytes buffered by this module."""
+    ser.reset_input_buffer()
+    _rx_buffer(ser).clear()
+
+
+def _discard_pending(ser: serial.Serial):
+    # Drop unread replies without the driver flush that reset_input() costs
+    _rx_buffer(ser).clear()
+    if pending := ser.in_waiting:
+        ser.read(pending)
+
+
+def _request_snapshot(ser: serial.Serial):
+    ser.write(b'?')
+    ser.flush()
+
+
+def _receive_snapshot(ser: serial.Serial, timeout_s: float = 1.0) -> Optional[bytes]:
+    """Wait for a snapshot line, skipping anything else; None on timeout."""
+    for line in _readlines(ser, timeout_s):
+        if _SNAPSHOT_RE.fullmatch(line):
+            return line
+    return None
+
+
+def _parse_snapshot(line: bytes) -> numpy.ndarray:
+    return numpy.fromstring(line, dtype=numpy.int32, sep=',')
+
+
+def read_snapshot(ser: serial.Serial, timeout_s: float = 1.0, retries: int = 3) -> numpy.ndarray:
+    """
+    Request one CSV snapshot ('?') and parse its 64 ADC values, retrying if needed.
+
+    Anything received before the request is discarded, so the reply always answers it.
+
+    :param ser: serial connection to the board
+    :param timeout_s: how long to wait for a reply per attempt
+    :param retries: number of attempts before giving up
+    :return: the 64 values in rank-major order
+    """
+    for attempt in range(retries):
+        try:
+            if attempt:
+                reset_input(ser)  # drop whatever is left of the attempt we gave up on
+            else:
+                _discard_pending(ser)
+            _request_snapshot(ser)
+            if (line := _receive_snapshot(ser, timeout_s)) is not None:
+                return _parse_snapshot(line)
+        except Exception:
+            pass  # ignore transient serial errors
+        logging.warning('CSV read timeout — retrying...')
+        time.sleep(1.0)
+
+    raise TimeoutError('Failed to get CSV snapshot after multiple retries')
+
+
+def read_thresholds(ser: serial.Serial, timeout_s: float = 1.0,
+                    retries: int = 3) -> Tuple[List[int], bool]:
+    """
+    Request the current thresholds ('!'), retrying if needed.
+
+    :param ser: serial connection to the board
+    :param timeout_s: how long to wait for a reply per attempt
+    :param retries: number of attempts before giving up
+    :return: the values (1 for a global threshold, 64 per-square ones) and whether it is global
+    """
+    for attempt in range(retries):
+        try:
+            if attempt:
+                reset_input(ser)  # drop whatever is left of the attempt we gave up on
+            else:
+                _discard_pending(ser)
+            ser.write(b'!')
+            ser.flush()
+
+            for line in _readlines(ser, timeout_s):
+                m = _THRESHOLDS_RE.fullmatch(line)
+                if not m:
+                    continue
+                groups = m.groups()
+                # Either a single integer (global) or 64 integers (per-square)
+                is_global = groups[64] is not None
+                vals = [int(groups[64])] if is_global else list(map(int, groups[:64]))
+                return vals, is_global
+        except Exception:
+            pass
+        logging.warning('Threshold read timeout — retrying...')
+        time.sleep(1.0)
+
+    raise TimeoutError('Failed to get thresholds after multiple retries')
+
+
+def read_frames(ser: serial.Serial, samples: int, delay_s: float) -> numpy.ndarray:
+    """
+    Take several snapshots and stack them into one array.
+
+    :param ser: serial connection to the board
+    :param samples: number of snapshots to take
+    :param delay_s: minimum interval between the starts of consecutive snapshots
+    :return: a (samples, 64) uint16 array, one row per snapshot
+    :raises ValueError: if samples is less than 1
+    """
+    if samples < 1:
+        raise ValueError('Need at least one snapshot')
+
+    frames = numpy.empty((samples, 64), dtype=numpy.uint16)  # 10-bit ADC values
+    fell_back = False
+    _discard_pending(ser)
+    t0 = time.monotonic()
+    _request_snapshot(ser)
+    for i in range(samples):
+        line = _receive_snapshot(ser)
+        if line is None:
+            # Reply lost: drop anything still in flight and fall back to retried requests
+            reset_input(ser)
+            vals = read_snapshot(ser)
+            fell_back = True
+        if i + 1 < samples:
+            # The serial round trip already counts towards the interval
+            time.sleep(max(0.0, delay_s - (time.monotonic() - t0)))
+            t0 = time.monotonic()
+            # Ask for the next snapshot before parsing this one so the board answers meanwhile
+            _request_snapshot(ser)
+        frames[i] = vals if line is None else _parse_snapshot(line)
+    if fell_back:
+        # A late reply to the lost request leaves one surplus snapshot behind
+        reset_input(ser)
+    return frames
+
+
+def average_readings(ser: serial.Serial, samples: int, delay_s: float) -> numpy.ndarray:
+    """
+    Average several snapshots.
+
+    :param ser: serial connection to the board
+    :param samples: number of snapshots to take
+    :param delay_s: minimum interval between the starts of consecutive snapshots
+    :return: the truncated per-square means as uint16, the width of the firmware's values
+    :raises ValueError: if samples is less than 1
+    """
+    frames = read_frames(ser, samples, delay_s)
+    return (frames.sum(axis=0, dtype=numpy.int64) // samples).astype(numpy.uint16)
+
+
+def format_csv(values) -> str:
+    """Format integer values as a plain CSV string, e.g. "512,498,..."."""
+    return ','.join(numpy.char.mod('%d', numpy.asarray(values, dtype=numpy.int32)))
+
+
+def _send_calibration(ser: serial.Serial, value_line: str, timeout_s: float = 1.0) -> bool:
+    """Send 'c' (enter calibration mode) and the value line in one write, then wait for OK."""
+    reset_input(ser)
+    ser.write(b'c' + value_line.encode('ascii'))
+    ser.flush()
+
+    for line in _readlines(ser, timeout_s):
+        if b'OK' in line:
+            return True
+    return False
+
+
+def push_threshold_global(ser: serial.Serial, value: int) -> bool:
+    """
+    Send a global threshold value to the board via its calibration mode.
+
+    :return: whether the board acknowledged the new threshold
+    """
+    return _send_calibration(ser, f'{value}\n')
+
+
+def push_threshold_individual(ser: serial.Serial, values: Sequence[int]) -> bool:
+    """
+    Send 64 per-square thresholds (rank-major) to the board via its calibration mode.
+
+    :return: whether the board acknowledged the new thresholds
+    """
+    if len(values) != 64:
+        raise ValueError('Need exactly 64 threshold values')
+
+    # Format: plain CSV (no brackets/spaces required; spaces tolerated by Arduino)
+    return _send_calibration(ser, format_csv(values) + '\n')
@@ -0,0 +1,224 @@
+#  LiBoard
+#  Copyright (C) 2021 Philipp Leclercq
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License version 3 as published by
+#  the Free Software Foundation.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import subprocess
+import sys
+from itertools import count
+
+import numpy
+import pytest
+
+from liboard import _kernels, calibration
+
+class FakeSerial:
+    """Answers '?', '!' and 'c' like the board firmware does."""
+
+    def __init__(self, snapshots, thresholds=b'512', ack=True, noise=b'', drop=0, late=0):
+        self.port = 'fake'
+        self.timeout = 1
+        self.written = bytearray()
+        self._snapshots = iter(snapshots)
+        self._thresholds = thresholds
+        self._ack = ack
+        self._out = bytearray(noise)
+        self._drop = drop  # number of '?' requests to leave unanswered
+        self._late = late  # number of '?' replies held back until the next request
+        self._held = bytearray()
+
+    @property
+    def in_waiting(self):
+        return len(self._out)
+
+    def read(self, size=1):
+        data = bytes(self._out[:size])
+        del self._out[:size]
+        return data
+
+    def write(self, data):
+        self.written += data
+        if data == b'?' and self._drop:
+            self._drop -= 1
+        elif data == b'?':
+            reply = ','.join(map(str, next(self._snapshots))).encode() + b'\r\n'
+            self._out += self._held
+            self._held.clear()
+            if self._late:
+                self._late -= 1
+                self._held += reply
+            else:
+                self._out += reply
+        elif data == b'!':
+            self._out += self._thresholds + b'\r\n'
+        elif data.startswith(b'c') and self._ack:
+            self._out += b'OK\r\n'
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self._out.clear()
+
+
+@pytest.mark.parametrize(('square', 'expected'), [
+    ('A1', 0), ('H1', 7), ('A2', 8), ('C4', 26), ('H8', 63)
+])
+def test_sq_to_idx(square: str, expected: int):
+    assert calibration.SQ_TO_IDX[square] == expected
+
+
+def test_buffers_are_per_connection():
+    first = FakeSerial([], noise=b'1,2')  # partial line left behind
+    calibration._readline(first, 0)
+    second = FakeSerial([[10] * 64])
+    assert calibration.read_snapshot(second)[0] == 10
+    assert len(calibration._rx_buffer(first)) == 3
+
+
+def test_rank_indices():
+    expected = [[calibration.SQ_TO_IDX[f + r] for f in calibration.FILES]
+                for r in calibration.RANKS]
+    assert calibration.RANK_INDICES.tolist() == expected
+
+
+def test_read_snapshot_skips_noise():
+    ser = FakeSerial([range(64)], noise=b'\x00\xff\n1,2,3\n')
+    assert calibration.read_snapshot(ser).tolist() == list(range(64))
+
+
+def test_read_snapshot_ignores_stale_snapshot():
+    ser = FakeSerial([[900] * 64], noise=b','.join([b'13'] * 64) + b'\r\n')
+    assert calibration.read_snapshot(ser)[0] == 900
+    assert not ser.in_waiting  # its own reply was consumed
+
+
+@pytest.mark.parametrize(('reply', 'expected'), [
+    (b'512', ([512], True)),
+    (b'512,', ([512], True)),
+    (b','.join(b'%d' % i for i in range(64)), (list(range(64)), False)),
+])
+def test_read_thresholds(reply: bytes, expected: tuple):
+    assert calibration.read_thresholds(FakeSerial([], thresholds=reply)) == expected
+
+
+def test_read_frames():
+    ser = FakeSerial([[10] * 64, [11] * 64, [13] * 64])
+    frames = calibration.read_frames(ser, 3, 0)
+    assert frames.shape == (3, 64)
+    assert frames.dtype == 'uint16'
+    assert frames.min(axis=0).tolist() == [10] * 64
+
+
+def test_read_frames_ignores_stale_snapshot():
+    ser = FakeSerial([[10] * 64, [11] * 64], noise=b','.join([b'13'] * 64) + b'\r\n')
+    assert calibration.read_frames(ser, 2, 0)[:, 0].tolist() == [10, 11]
+
+
+def test_read_frames_lost_reply():
+    ser = FakeSerial([[10] * 64, [11] * 64], drop=1)
+    assert calibration.read_frames(ser, 2, 0)[:, 0].tolist() == [10, 11]
+    assert bytes(ser.written) == b'???'
+
+
+def test_read_frames_late_reply():
+    ser = FakeSerial([[10] * 64, [11] * 64, [12] * 64, [13] * 64, [900] * 64], late=1)
+    assert calibration.read_frames(ser, 3, 0)[:, 0].tolist() == [10, 11, 12]
+    # The surplus reply must not be mistaken for the next capture
+    assert calibration.read_snapshot(ser)[0] == 900
+
+
+def test_read_frames_no_samples():
+    ser = FakeSerial([])
+    with pytest.raises(ValueError):
+        calibration.read_frames(ser, 0, 0)
+    assert not ser.written
+
+
+def test_average_readings_no_samples():
+    with pytest.raises(ValueError):
+        calibration.average_readings(FakeSerial([]), 0, 0)
+
+
+def test_average_readings():
+    ser = FakeSerial([[10] * 64, [11] * 64, [13] * 64])
+    avg = calibration.average_readings(ser, 3, 0)
+    assert avg.dtype == 'uint16'
+    assert avg.tolist() == [11] * 64
+
+
+@pytest.mark.parametrize('ack', [True, False])
+def test_push_threshold_individual(ack: bool):
+    ser = FakeSerial([], ack=ack)
+    assert calibration.push_threshold_individual(ser, list(range(64))) is ack
+    assert bytes(ser.written) == b'c' + b','.join(b'%d' % i for i in range(64)) + b'\n'
+
+
+@pytest.mark.parametrize('jit_min_frames', [_kernels.JIT_MIN_FRAMES, 1])
+def test_frame_stats(monkeypatch, jit_min_frames: int):
+    monkeypatch.setattr(_kernels, 'JIT_MIN_FRAMES', jit_min_frames)
+    frames = numpy.array([[10, 7], [11, 9], [13, 3]], dtype=numpy.uint16)
+    for stats in (_kernels.frame_stats, _kernels._frame_stats_loop):
+        mean, mn, mx = stats(frames)
+        assert (mean.tolist(), mn.tolist(), mx.tolist()) == ([11, 6], [10, 3], [13, 9])
+
+
+def test_frame_stats_empty():
+    frames = numpy.empty((0, 64), dtype=numpy.uint16)
+    for stats in (_kernels.frame_stats, _kernels._frame_stats_loop):
+        with pytest.raises(ValueError):
+            stats(frames)
+
+
+def test_small_captures_do_not_import_numba():
+    code = ('import sys, numpy; from liboard import _kernels, calibration; '
+            '_kernels.frame_stats(numpy.ones((15, 64), numpy.uint16)); '
+            'assert "numba" not in sys.modules')
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+
+def test_push_gives_up_on_chatter(monkeypatch):
+    class ChattySerial(FakeSerial):
+        def read(self, size=1):
+            return b'status\n'  # never the OK being waited for
+
+    clock = count(step=0.25)
+    monkeypatch.setattr(calibration.time, 'monotonic', lambda: next(clock))
+    assert calibration.push_threshold_global(ChattySerial([]), 512) is False
+
+
+def test_read_gives_up_on_bytes_without_newline(monkeypatch):
+    class BinarySerial(FakeSerial):
+        def read(self, size=1):
+            return b'\x00\xff'  # e.g. bitboard frames when quiet mode did not take
+
+    clock = count(step=0.25)
+    monkeypatch.setattr(calibration.time, 'monotonic', lambda: next(clock))
+    monkeypatch.setattr(calibration.time, 'sleep', lambda s: None)
+    with pytest.raises(TimeoutError):
+        calibration.read_snapshot(BinarySerial([[10] * 64] * 3))
+
+
+def test_timeout_set_only_when_changed():
+    class CountingSerial(FakeSerial):
+        timeout_sets = 0
+
+        def __setattr__(self, name, value):
+            if name == 'timeout':
+                CountingSerial.timeout_sets += 1
+            super().__setattr__(name, value)
+
+    ser = CountingSerial([[10] * 64] * 3)
+    CountingSerial.timeout_sets = 0
+    calibration.read_frames(ser, 3, 0)
+    assert CountingSerial.timeout_sets == 0  # already 1 s from construction